@@ -1,11 +1,22 @@
 import streamlit as st
-import nest_asyncio
+import asyncio
 from utils import (
     get_supabase, get_user_role_from_supabase, get_display_name,
-    is_admin, display_logo
+    is_admin, display_logo, APP_CSS
 )
 
-nest_asyncio.apply()
+# LlamaParse calls asyncio.run() internally, which only breaks inside an already
+# running loop. Script runs, parse workers and indexing threads have none, so the
+# patch (which slows every event loop) is only applied if one is actually running
+try:
+    asyncio.get_running_loop()
+except RuntimeError:
+    pass
+else:
+    import nest_asyncio
+    if not getattr(nest_asyncio, "_applied", False):
+        nest_asyncio.apply()
+        nest_asyncio._applied = True
 
 st.set_page_config(
     page_title="Engineer Advisor",
@@ -14,37 +25,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-st.markdown("""
-    <style>
-    .main-header { font-size: 2.5rem; font-weight: 700; color: #4da6ff; margin-bottom: 0.5rem; }
-    .sub-header { font-size: 1.2rem; color: #aaa; margin-bottom: 2rem; }
-    .stButton>button { width: 100%; border-radius: 5px; height: 3em; font-weight: 600; }
-    .success-box {
-        padding: 1.5rem; border-radius: 8px;
-        background-color: #1e3a1e; border: 2px solid #2d5a2d;
-        margin: 1rem 0; color: #ffffff; line-height: 1.6;
-    }
-    .admin-badge {
-        background-color: #ff6b6b; color: white;
-        padding: 0.2rem 0.5rem; border-radius: 3px;
-        font-size: 0.8rem; font-weight: bold;
-    }
-    .user-badge {
-        background-color: #4dabf7; color: white;
-        padding: 0.2rem 0.5rem; border-radius: 3px;
-        font-size: 0.8rem; font-weight: bold;
-    }
-    .logo-container {
-        text-align: center; padding: 1rem 0 2rem 0;
-        border-bottom: 2px solid #333; margin-bottom: 2rem;
-    }
-    .company-name { font-size: 2rem; font-weight: 700; color: #4da6ff; margin-top: 0.5rem; }
-    .guide-box {
-        background-color: #1e1e2e; border-left: 4px solid #4da6ff;
-        padding: 1rem; margin: 0.5rem 0; border-radius: 4px;
-    }
-    </style>
-""", unsafe_allow_html=True)
+# Must be re-emitted each run: Streamlit drops elements a rerun doesn't redraw.
+# st.html injects it as-is, skipping the markdown parser
+st.html(APP_CSS)
 
 # ============================================================================
 # SESSION STATE
@@ -150,17 +133,9 @@ if not st.session_state['authenticated']:
 # SIDEBAR — lean
 # ============================================================================
 
-with st.sidebar:
-    role_badge = "<span class='admin-badge'>ADMIN</span>" if is_admin() else "<span class='user-badge'>ENGINEER</span>"
-    st.markdown(f"""
-        <div style='padding: 0.5rem 0 0.75rem 0;'>
-            <div style='font-size: 0.85rem; color: #aaa; margin-bottom: 0.25rem;'>Logged in as</div>
-            <div style='font-size: 1.1rem; font-weight: 600; margin-bottom: 0.4rem;'>👤 {st.session_state['username']}</div>
-            <div>{role_badge}</div>
-        </div>
-    """, unsafe_allow_html=True)
-    st.markdown("---")
-
+# Fragment: submitting the form reruns only this block, not every page
+@st.fragment
+def render_password_change():
     with st.expander("🔐 Change Password"):
         with st.form("pw_change"):
             current_pw = st.text_input("Current", type="password")
@@ -184,6 +159,19 @@ with st.sidebar:
                         msg = str(e)
                         st.error("❌ Current password incorrect" if '400' in msg or 'Invalid' in msg else f"❌ {msg}")
 
+with st.sidebar:
+    role_badge = "<span class='admin-badge'>ADMIN</span>" if is_admin() else "<span class='user-badge'>ENGINEER</span>"
+    st.markdown(f"""
+        <div style='padding: 0.5rem 0 0.75rem 0;'>
+            <div style='font-size: 0.85rem; color: #aaa; margin-bottom: 0.25rem;'>Logged in as</div>
+            <div style='font-size: 1.1rem; font-weight: 600; margin-bottom: 0.4rem;'>👤 {st.session_state['username']}</div>
+            <div>{role_badge}</div>
+        </div>
+        <hr style='margin: 0.5rem 0 1rem 0;'>
+    """, unsafe_allow_html=True)
+
+    render_password_change()
+
     st.markdown("---")
 
     if st.button("🚪 Logout", use_container_width=True):
@@ -1,14 +1,39 @@
 import streamlit as st
 import os
-import shutil
-import json
-import tempfile
+import io
+import orjson
+import zipfile
 import threading
 from datetime import datetime
-from utils import require_admin, get_supabase, list_manuals, upload_manual, download_manual, delete_manual, insert_manuals_into_index
+from utils import (require_admin, get_supabase, list_manuals, upload_manual, save_manual_local, get_manual_bytes,
+                   delete_manual, insert_manuals_into_index, load_quick_guides_local, load_index,
+                   get_llm_and_embed, build_query_engine, batched_query, run_async,
+                   clear_local_index, invalidate_index_cache, _supabase_direct,
+                   INDEX_JOB_LOCK, index_job_running)
 
 require_admin()
 
+@st.cache_data(ttl=30, show_spinner=False)
+def storage_status():
+    """Index files and manual count in Supabase Storage for the System tab.
+    One listing per bucket; file sizes come from the listing metadata, so
+    nothing is downloaded. Anything that changes storage clears the cache."""
+    status = {}
+    sb = _supabase_direct()
+    try:
+        sizes = {f['name']: (f.get('metadata') or {}).get('size', 0) for f in sb.storage.from_('index').list()}
+    except Exception:
+        sizes = {}
+    for name in ('index_store.json', 'default__vector_store.json'):
+        status[name] = sizes[name] > 0 if name in sizes else None  # None: not stored (or unreachable)
+    try:
+        manual_files = [f['name'] for f in sb.storage.from_('manuals').list()]
+        status['manuals'] = len([f for f in manual_files if f.endswith('.pdf')])
+        status['manuals_error'] = None
+    except Exception as e:
+        status['manuals'], status['manuals_error'] = None, str(e)
+    return status
+
 st.markdown("## ⚙️ Admin Panel")
 st.markdown("---")
 
@@ -24,56 +49,87 @@ with tab1:
 
     # Show background indexing status
     import builtins as _builtins
-    import time
+
+    @st.fragment(run_every=3)
+    def index_status():
+        """Poll the background insert without blocking the page; rerun it once done."""
+        job = getattr(_builtins, '_index_job', None)
+        if job is None or job['done']:
+            st.rerun(scope="app")
+        st.warning(f"⏳ Indexing in progress: {', '.join(job['files'])} — you can navigate away safely")
+
     job = getattr(_builtins, '_index_job', None)
     if job:
         if not job['done']:
-            st.warning(f"⏳ Indexing in progress: {', '.join(job['files'])} — you can navigate away safely")
-            time.sleep(3)
-            st.rerun()
-        elif job['ok']:
-            st.success(f"✅ Indexing complete: {', '.join(job['files'])}")
-            st.cache_resource.clear()
-            _builtins._index_job = None
+            index_status()
         else:
-            st.error(f"❌ Indexing failed: {job['err']}")
-            _builtins._index_job = None
+            if job['ok']:
+                st.success(f"✅ Indexing complete: {', '.join(job['files'])}")
+                storage_status.clear()
+            else:
+                st.error(f"❌ Indexing failed: {job['err']}")
+            with INDEX_JOB_LOCK:
+                if _builtins._index_job is job:
+                    _builtins._index_job = None
 
     uploaded_files = st.file_uploader("Upload PDF Manuals", type="pdf", accept_multiple_files=True)
 
     if uploaded_files:
+        upload_job = None
         if st.button(f"⬆️ Upload & Index {len(uploaded_files)} file(s)"):
-            # Step 1 — Upload all files to Supabase Storage
-            success, failed = [], []
-            for uploaded_file in uploaded_files:
-                with st.spinner(f"Uploading {uploaded_file.name}..."):
-                    ok, err = upload_manual(uploaded_file.name, uploaded_file.getvalue())
-                if ok:
-                    success.append(uploaded_file.name)
-                else:
-                    failed.append((uploaded_file.name, err))
-
-            for name, err in failed:
-                st.error(f"❌ {name} failed to upload: {err}")
-
-            # Step 2 — Kick off indexing in a background thread so navigation won't kill it
-            if success:
-                def _index_in_background(filenames):
-                    import builtins
-                    try:
-                        ok, err = insert_manuals_into_index(filenames)
-                    except Exception as e:
-                        ok, err = False, f"Unhandled exception: {e}"
-                    builtins._index_job = {"done": True, "ok": ok, "err": err, "files": filenames}
+            # Claim the job slot before uploading, so a second click or admin is refused
+            with INDEX_JOB_LOCK:
+                if not index_job_running():
+                    upload_job = {"done": False, "files": [f.name for f in uploaded_files]}
+                    _builtins._index_job = upload_job
+            if upload_job is None:
+                st.warning("⏳ Indexing is already running — upload again once it finishes")
+        if upload_job is not None:
+            started = False
+            try:
+                # Step 1 — Save locally (the indexer reads it from here), then upload to Supabase Storage
+                success, failed = [], []
+                for uploaded_file in uploaded_files:
+                    with st.spinner(f"Uploading {uploaded_file.name}..."):
+                        part_path = save_manual_local(uploaded_file.name, uploaded_file)
+                        ok, err = upload_manual(uploaded_file.name, part_path)
+                    if ok:
+                        os.replace(part_path, f"./manuals/{uploaded_file.name}")
+                        success.append(uploaded_file.name)
+                    else:
+                        os.remove(part_path)
+                        failed.append((uploaded_file.name, err))
 
-                builtins_import = __import__('builtins')
-                builtins_import._index_job = {"done": False, "files": success}
+                for name, err in failed:
+                    st.error(f"❌ {name} failed to upload: {err}")
 
-                thread = threading.Thread(target=_index_in_background, args=(success,), daemon=True)
-                thread.start()
+                # Step 2 — Kick off indexing in a background thread so navigation won't kill it
+                if success:
+                    storage_status.clear()
 
-                st.success(f"✅ Uploaded: {', '.join(success)}")
-                st.info("🔄 Indexing running in background — you can navigate away safely. Check back here to see when it's done.")
+                    def _index_in_background(job):
+                        try:
+                            ok, err = insert_manuals_into_index(job['files'])
+                        except Exception as e:
+                            ok, err = False, f"Unhandled exception: {e}"
+                        if ok:
+                            invalidate_index_cache()  # even if no admin is watching this page
+                        with INDEX_JOB_LOCK:
+                            job.update(ok=ok, err=err, done=True)
+
+                    upload_job['files'] = success
+                    thread = threading.Thread(target=_index_in_background, args=(upload_job,), daemon=True)
+                    thread.start()
+                    started = True
+
+                    st.success(f"✅ Uploaded: {', '.join(success)}")
+                    st.info("🔄 Indexing running in background — you can navigate away safely. Check back here to see when it's done.")
+            finally:
+                # Nothing to index: release the slot claimed above
+                if not started:
+                    with INDEX_JOB_LOCK:
+                        if _builtins._index_job is upload_job:
+                            _builtins._index_job = None
 
     st.markdown("---")
     st.subheader("Current Manuals")
@@ -84,20 +140,32 @@ with tab1:
             with col1:
                 st.caption(f"📄 {f}")
             with col2:
-                pdf_bytes = download_manual(f)
-                if pdf_bytes:
-                    st.download_button("📥", data=pdf_bytes, file_name=f,
-                                       mime="application/pdf", key=f"dl_{f}")
+                # Fetch on demand — downloading every PDF on each rerun is expensive
+                if st.button("📥", key=f"get_{f}"):
+                    pdf_bytes = get_manual_bytes(f)
+                    if pdf_bytes:
+                        st.download_button("💾", data=pdf_bytes, file_name=f,
+                                           mime="application/pdf", key=f"dl_{f}")
+                    else:
+                        st.error("Fetch failed")
             with col3:
                 if st.button("🗑️", key=f"del_pdf_{f}"):
-                    if delete_manual(f):
-                        local_path = f"./manuals/{f}"
-                        if os.path.exists(local_path):
-                            os.remove(local_path)
-                        # Full rebuild needed on delete (can't remove from index incrementally)
-                        if os.path.exists("./storage"):
-                            shutil.rmtree("./storage")
-                        st.cache_resource.clear()
+                    # Held throughout, so no build can start while the index is dropped
+                    with INDEX_JOB_LOCK:
+                        busy = index_job_running()
+                        deleted = not busy and delete_manual(f)
+                        if deleted:
+                            local_path = f"./manuals/{f}"
+                            if os.path.exists(local_path):
+                                os.remove(local_path)
+                            # Full rebuild needed on delete (can't remove from index incrementally)
+                            clear_local_index()
+                            invalidate_index_cache()
+                            storage_status.clear()
+                            _builtins._build_job = None  # finished, since none is running
+                    if busy:
+                        st.warning("⏳ Indexing is running — delete once it finishes")
+                    elif deleted:
                         st.success(f"Deleted {f} — visit Search to rebuild index")
                         st.rerun()
                     else:
@@ -115,53 +183,76 @@ with tab2:
     col1, col2 = st.columns(2)
     with col1:
         if st.button("🗑️ Clear Cache", use_container_width=True):
-            st.cache_resource.clear()
+            invalidate_index_cache()
+            list_manuals.clear()
+            storage_status.clear()
             st.success("Cache cleared!")
             st.rerun()
     with col2:
         if st.button("🔄 Rebuild Index", use_container_width=True):
-            # Delete local storage
-            if os.path.exists("./storage"):
-                shutil.rmtree("./storage")
-            # Delete index files from Supabase Storage
-            supabase = get_supabase()
-            try:
-                from utils import INDEX_FILES
-                supabase.storage.from_('index').remove(INDEX_FILES)
-            except Exception as e:
-                st.warning(f"Could not clear Supabase index: {e}")
-            st.cache_resource.clear()
-            st.success("✅ Index cleared — visit Search to rebuild from scratch")
-            st.rerun()
+            # Held throughout, so no build can start while the index is dropped
+            with INDEX_JOB_LOCK:
+                busy = index_job_running()
+                if not busy:
+                    # Delete local storage
+                    clear_local_index()
+                    # Delete index files from Supabase Storage
+                    supabase = get_supabase()
+                    try:
+                        from utils import INDEX_FILES
+                        supabase.storage.from_('index').remove(INDEX_FILES)
+                    except Exception as e:
+                        st.warning(f"Could not clear Supabase index: {e}")
+                    invalidate_index_cache()
+                    storage_status.clear()
+                    _builtins._build_job = None  # finished, since none is running
+            if busy:
+                st.warning("⏳ Indexing is running — rebuild once it finishes")
+            else:
+                st.success("✅ Index cleared — visit Search to rebuild from scratch")
+                st.rerun()
 
     st.markdown("---")
     st.subheader("Storage Status")
     st.caption("Index and manuals are stored in Supabase Storage.")
 
-    supabase = get_supabase()
-
-    # Index bucket status
-    from utils import _supabase_direct
-    _sb = _supabase_direct()
-    try:
-        test_data = _sb.storage.from_('index').download('index_store.json')
-        has_index = len(test_data) > 0
-        st.caption(f"{'✅' if has_index else '❌'} index_store.json (Supabase)")
-        try:
-            vec_data = _sb.storage.from_('index').download('default__vector_store.json')
-            st.caption(f"{'✅' if len(vec_data) > 0 else '❌'} default__vector_store.json (Supabase)")
-        except Exception:
-            st.caption("❌ default__vector_store.json (Supabase)")
-    except Exception:
+    status = storage_status()
+    if status['index_store.json'] is None:
         st.caption("❌ index_store.json (Supabase) — no index found")
+    else:
+        st.caption(f"{'✅' if status['index_store.json'] else '❌'} index_store.json (Supabase)")
+        st.caption(f"{'✅' if status['default__vector_store.json'] else '❌'} default__vector_store.json (Supabase)")
 
     # Manuals bucket status
-    try:
-        manual_files = [f['name'] for f in supabase.storage.from_('manuals').list()]
-        pdf_count = len([f for f in manual_files if f.endswith('.pdf')])
-        st.caption(f"📚 Manuals in Supabase: {pdf_count} file(s)")
-    except Exception as e:
-        st.warning(f"⚠️ Could not check manuals bucket: {e}")
+    if status['manuals_error']:
+        st.warning(f"⚠️ Could not check manuals bucket: {status['manuals_error']}")
+    else:
+        st.caption(f"📚 Manuals in Supabase: {status['manuals']} file(s)")
+
+    st.markdown("---")
+    st.subheader("Test Index")
+    st.caption("Runs sample questions against the current index concurrently.")
+    test_queries = st.text_area("One question per line", value="\n".join([
+        "How do I troubleshoot door sensor connectivity issues?",
+        "What are the wiring connections for panel zone 1?",
+        "How do I reset the main control panel?",
+    ]))
+    if st.button("🧪 Run Test Queries", use_container_width=True):
+        queries = [q.strip() for q in test_queries.splitlines() if q.strip()]
+        if not os.path.exists("./storage/index_store.json"):
+            st.warning("No local index — visit Search to build it")
+        elif queries:
+            try:
+                from llama_index.core import Settings
+                Settings.llm, Settings.embed_model = get_llm_and_embed()
+                engine = build_query_engine(load_index())
+                with st.spinner(f"Running {len(queries)} queries..."):
+                    responses = run_async(batched_query(engine, queries))
+                for q, r in zip(queries, responses):
+                    with st.expander(q):
+                        st.markdown(r.response)
+            except Exception as e:
+                st.error(f"❌ Test queries failed: {e}")
 
 # ============================================================================
 # TAB 3 — BACKUP
@@ -182,29 +273,23 @@ with tab3:
                         'default__vector_store.json', 'graph_store.json',
                         'image__vector_store.json', '.index_ready'
                     ]
-                    guides_file = './storage/quick_guides.json'
-                    if os.path.exists(guides_file):
-                        try:
-                            with open(guides_file, 'r') as f:
-                                if json.load(f):
-                                    essential_files.append('quick_guides.json')
-                        except Exception:
-                            pass
-
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        backup_folder = os.path.join(tmpdir, "storage")
-                        os.makedirs(backup_folder)
+                    local_guides = load_quick_guides_local()
+
+                    # Index files are mostly already-compact binary, so store rather than deflate
+                    buf = io.BytesIO()
+                    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as z:
                         for file in essential_files:
                             src = os.path.join(storage_path, file)
                             if os.path.exists(src):
                                 dst_name = 'index_ready' if file == '.index_ready' else file
-                                shutil.copy2(src, os.path.join(backup_folder, dst_name))
-
-                        backup_name = f"index_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                        shutil.make_archive(backup_name, 'zip', tmpdir)
-                        with open(f"{backup_name}.zip", "rb") as f:
-                            st.download_button("⬇️ Download Backup", f, f"{backup_name}.zip", "application/zip")
-                        os.remove(f"{backup_name}.zip")
+                                z.write(src, f"storage/{dst_name}")
+                        # Guides are exported as JSON; it is imported on first use if guides.db is absent
+                        if local_guides:
+                            z.writestr("storage/quick_guides.json",
+                                       orjson.dumps(local_guides, option=orjson.OPT_INDENT_2))
+
+                    backup_name = f"index_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                    st.download_button("⬇️ Download Backup", buf.getvalue(), f"{backup_name}.zip", "application/zip")
                     st.success("✅ Backup ready")
                     st.caption("Rename 'index_ready' to '.index_ready' when uploading to GitHub")
                 except Exception as e:
@@ -214,13 +299,13 @@ with tab3:
 
     with col2:
         if st.button("📝 Download Guides JSON", use_container_width=True):
-            guides_file = "./storage/quick_guides.json"
-            if os.path.exists(guides_file):
-                with open(guides_file, "rb") as f:
-                    st.download_button("⬇️ Download", f, "quick_guides.json", "application/json")
+            local_guides = load_quick_guides_local()
+            if local_guides:
+                st.download_button("⬇️ Download", orjson.dumps(local_guides, option=orjson.OPT_INDENT_2),
+                                   "quick_guides.json", "application/json")
                 st.caption("Save to storage/ in your repo")
             else:
-                st.warning("No guides file found")
+                st.warning("No local guides found")
 
 # ============================================================================
 # TAB 4 — USER MANAGEMENT
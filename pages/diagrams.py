@@ -1,6 +1,6 @@
 import streamlit as st
 import os
-from utils import require_auth, list_manuals, download_manual
+from utils import require_auth, list_manuals, list_diagrams, get_manual_bytes, file_bytes, image_preview
 
 require_auth()
 
@@ -21,7 +21,7 @@ with col1:
         selected_pdf = st.selectbox("Select Manual", pdf_files)
         if selected_pdf:
             with st.spinner("Fetching..."):
-                pdf_bytes = download_manual(selected_pdf)
+                pdf_bytes = get_manual_bytes(selected_pdf)
             if pdf_bytes:
                 st.download_button(
                     label="📥 Download PDF",
@@ -43,26 +43,21 @@ with col2:
     st.subheader("🖼️ Diagrams")
 
     if os.path.exists("./diagrams"):
-        diagram_files = [f for f in os.listdir("./diagrams")
-                         if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+        diagrams = list_diagrams()
 
-        if diagram_files:
-            diagram_names = {f: f.replace('-', ' ').replace('_', ' ').rsplit('.', 1)[0].title()
-                             for f in diagram_files}
-
-            selected_diagram = st.selectbox("Select Diagram", list(diagram_names.values()))
+        if diagrams:
+            selected_diagram = st.selectbox("Select Diagram", list(diagrams))
 
             if selected_diagram:
-                filename = [k for k, v in diagram_names.items() if v == selected_diagram][0]
+                filename = diagrams[selected_diagram]
                 diagram_path = f"./diagrams/{filename}"
-                st.image(diagram_path, caption=selected_diagram, use_container_width=True)
+                st.image(image_preview(diagram_path), caption=selected_diagram, use_container_width=True)
 
-                with open(diagram_path, "rb") as f:
-                    st.download_button(
-                        label="📥 Download Image",
-                        data=f,
-                        file_name=filename
-                    )
+                st.download_button(
+                    label="📥 Download Image",
+                    data=file_bytes(diagram_path),
+                    file_name=filename
+                )
                 st.caption("💡 Click image to zoom • Right-click to open in new tab")
         else:
             st.info("No diagrams available yet")
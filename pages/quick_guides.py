@@ -21,8 +21,8 @@ with st.expander("➕ Add New Guide", expanded=False):
             if guide_title and guide_content:
                 result = save_quick_guide(guide_title, guide_content, st.session_state['username'])
                 if result:
+                    # The list below is read after this, so it already includes the new guide
                     st.success(f"✅ Guide '{guide_title}' saved!")
-                    st.rerun()
                 else:
                     st.error("❌ Failed to save guide")
             else:
@@ -40,6 +40,16 @@ if not guides:
 
 st.caption(f"📚 {len(guides)} guide(s) available")
 
+if is_admin():
+    # One picker + button instead of a delete button inside every guide
+    with st.expander("🗑️ Delete a Guide", expanded=False):
+        guide_titles = {g['id']: g['title'] for g in guides}
+        to_delete = st.selectbox("Guide", list(guide_titles), format_func=guide_titles.get,
+                                 index=None, placeholder="Select a guide...")
+        # Callback runs before the next script pass, so no extra rerun is needed
+        st.button("🗑️ Delete", disabled=to_delete is None,
+                  on_click=delete_quick_guide, args=(to_delete,))
+
 # Search/filter
 search = st.text_input("🔍 Filter guides", placeholder="Type to filter...")
 if search:
@@ -58,9 +68,3 @@ for guide in guides:
         st.markdown(f"**Author:** {guide['author']}  •  **Added:** {display_date}")
         st.markdown("---")
         st.text(guide['content'])
-
-        if is_admin():
-            if st.button("🗑️ Delete", key=f"del_{guide['id']}"):
-                delete_quick_guide(guide['id'])
-                st.success("Deleted!")
-                st.rerun()
@@ -1,12 +1,18 @@
 import streamlit as st
 import os
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, StorageContext, load_index_from_storage, Settings, PromptTemplate
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.llms.openai import OpenAI
-from llama_parse import LlamaParse
+import threading
+import builtins as _builtins
+from collections import OrderedDict
+from contextlib import ExitStack
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from llama_index.core import Settings
 from datetime import datetime
-from utils import (require_auth, find_quick_fix, load_quick_guides, get_quick_guides_as_text,
-                   sync_manuals_to_local, download_index_from_supabase, upload_index_to_supabase)
+from utils import (require_auth, get_llm_and_embed, build_query_engine,
+                   find_quick_fix, load_quick_guides_versioned, get_quick_guides_as_text, tokenize, guide_postings,
+                   STOP_WORDS,
+                   sync_manuals_to_local, download_index_from_supabase, upload_index_to_supabase,
+                   parse_manuals, build_index, load_index,
+                   manual_fingerprints, save_index_fingerprints, INDEX_JOB_LOCK, index_generation, invalidate_index_cache)
 
 require_auth()
 
@@ -15,10 +21,7 @@ require_auth()
 # =============================================================================
 
 try:
-    os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
-    os.environ["LLAMA_CLOUD_API_KEY"] = st.secrets["LLAMA_CLOUD_API_KEY"]
-    Settings.llm = OpenAI(model="gpt-4o-mini", temperature=0.1)
-    Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
+    Settings.llm, Settings.embed_model = get_llm_and_embed()
 except Exception as e:
     st.error(f"❌ API Configuration Error: {str(e)}")
     st.stop()
@@ -27,27 +30,31 @@ except Exception as e:
 # INDEX MANAGEMENT
 # ============================================================================
 
-@st.cache_resource(show_spinner=False)
-def get_advisor_index():
+@st.cache_resource(show_spinner=False, max_entries=1)
+def get_advisor_index(generation):
+    """Load the persisted index, restoring it from Supabase first.
+    Cached per index generation, which the admin bumps when the index changes.
+    Returns None when there is no usable index yet (missing or corrupt);
+    makes no Streamlit UI calls, the caller reports status."""
     os.makedirs("./manuals", exist_ok=True)
     os.makedirs("./storage", exist_ok=True)
     storage_path = "./storage"
 
     marker_file = "./storage/.index_ready"
-    required_files = ['docstore.json', 'index_store.json']
-    vector_files = ['vector_store.json', 'default__vector_store.json', 'image__vector_store.json']
+    required_files = {'docstore.json', 'index_store.json'}
+    vector_files = {'vector_store.json', 'default__vector_store.json', 'image__vector_store.json'}
 
     # Always try to restore index from Supabase Storage (overwrites stale local files)
     download_index_from_supabase()
 
-    has_required = all(os.path.exists(f"./storage/{f}") for f in required_files)
-    has_vector = any(os.path.exists(f"./storage/{f}") for f in vector_files)
-    has_marker = os.path.exists(marker_file)
+    files = set(os.listdir(storage_path))
+    has_required = required_files <= files
+    has_vector = bool(vector_files & files)
+    has_marker = '.index_ready' in files
 
     if has_required and has_vector:
         try:
-            sc = StorageContext.from_defaults(persist_dir=storage_path)
-            index = load_index_from_storage(sc)
+            index = load_index(storage_path)
             if not has_marker:
                 try:
                     with open(marker_file, 'w') as f:
@@ -55,29 +62,33 @@ def get_advisor_index():
                 except Exception:
                     pass
             return index
-        except Exception as e:
+        except Exception:
+            # Corrupt index: drop the marker and let the caller rebuild it
             if has_marker:
                 os.remove(marker_file)
-            st.warning(f"Index corrupted, rebuilding: {e}")
+    return None
 
-    # Sync PDFs from Supabase Storage to local dir for indexing
-    sync_manuals_to_local()
+def build_advisor_index():
+    """Parse every manual and build, persist and upload a fresh index.
+    Runs on a background thread; returns (success, error)."""
+    storage_path = "./storage"
 
-    pdf_files = [f for f in os.listdir("./manuals") if f.endswith('.pdf')]
+    # Sync PDFs from Supabase Storage to local dir for indexing
+    pdf_files = sync_manuals_to_local()
     if not pdf_files:
-        return None
+        return False, "No PDF files found"
 
     try:
-        parser = LlamaParse(result_type="markdown", invalidate_cache=False, do_not_cache=False)
-        documents = SimpleDirectoryReader("./manuals", file_extractor={".pdf": parser}).load_data()
+        documents = parse_manuals([f"./manuals/{f}" for f in pdf_files])
 
         guides_text = get_quick_guides_as_text()
         if guides_text:
             from llama_index.core import Document
             documents.append(Document(text=guides_text, metadata={"source": "quick_guides"}))
 
-        index = VectorStoreIndex.from_documents(documents)
+        index = build_index(documents)
         index.storage_context.persist(persist_dir=storage_path)
+        save_index_fingerprints(manual_fingerprints(pdf_files))
 
         with open("./storage/.index_ready", 'w') as f:
             f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
@@ -85,43 +96,121 @@ def get_advisor_index():
         # Push freshly built index to Supabase so it survives restarts
         upload_index_to_supabase()
 
-        return index
+        return True, None
     except Exception as e:
-        st.error(f"❌ Index failed: {str(e)}")
-        return None
+        return False, f"Index failed: {e}"
 
 # Load index
+generation = index_generation()
 with st.spinner("🔄 Initialising system..."):
-    index = get_advisor_index()
+    index = get_advisor_index(generation)
+
+# No index yet — build it in the background so the page (quick fixes and
+# guides) stays usable; the finished index is picked up on a later rerun
+@st.fragment(run_every=3)
+def build_status(job):
+    """Poll the background job without blocking the page; rerun it once done."""
+    if job['done']:
+        st.rerun(scope="app")
+    st.info("⏳ Building the manual index — quick fixes and guides work in the meantime")
 
 if index is None:
-    st.error("❌ No PDF files found")
-    st.info("💡 Upload PDFs via the Admin panel" if st.session_state.get('user_role') == 'admin' else "💡 Contact admin to upload manuals")
-    st.stop()
+    with INDEX_JOB_LOCK:
+        job = getattr(_builtins, '_build_job', None)
+        insert_job = getattr(_builtins, '_index_job', None)
+        if job is None and insert_job is not None and not insert_job['done']:
+            # An admin insert is running and builds the index if none exists; wait for it
+            job = insert_job
+        elif job is None:
+            def _build_in_background(job):
+                try:
+                    ok, err = build_advisor_index()
+                except Exception as e:
+                    ok, err = False, f"Unhandled exception: {e}"
+                if ok:
+                    invalidate_index_cache()
+                with INDEX_JOB_LOCK:
+                    job.update(ok=ok, err=err, done=True)
+
+            _builtins._build_job = job = {"done": False}
+            thread = threading.Thread(target=_build_in_background, args=(job,), daemon=True)
+            add_script_run_ctx(thread)
+            thread.start()
+
+    build_err = job.get('err')
+    if job['done'] and job['ok']:
+        generation = index_generation()
+        index = get_advisor_index(generation)
+        if index is None:
+            build_err = "The index was built but could not be loaded"
+        with INDEX_JOB_LOCK:
+            if _builtins._build_job is job:
+                if index is not None:
+                    _builtins._build_job = None
+                else:
+                    job.update(ok=False, err=build_err)
+
+    if index is None:
+        if not job['done']:
+            build_status(job)
+        elif build_err == "No PDF files found":
+            st.error("❌ No PDF files found")
+            st.info("💡 Upload PDFs via the Admin panel" if st.session_state.get('user_role') == 'admin' else "💡 Contact admin to upload manuals")
+            st.stop()
+        else:
+            st.error(f"❌ {build_err}")
+            if st.button("🔄 Retry index build"):
+                with INDEX_JOB_LOCK:
+                    if _builtins._build_job is job:
+                        _builtins._build_job = None
+                st.rerun()
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def get_query_engine(_index, generation):
+    """Build the query engine once per index generation, not per rerun.
+    An incremental insert keeps the index_id, so the generation is the key."""
+    return build_query_engine(_index, streaming=True)
 
-query_engine = index.as_query_engine(similarity_top_k=8)
-
-prompt_tmpl = PromptTemplate(
-    "Context information is below.\n"
-    "---------------------\n"
-    "{context_str}\n"
-    "---------------------\n"
-    "You are a senior field engineer helping a colleague. Answer naturally and conversationally.\n\n"
-    "ADAPT YOUR RESPONSE:\n"
-    "- Simple questions (what/where/when): Answer directly in 1-2 sentences\n"
-    "- How-to questions: Give clear, practical steps (3-5 steps)\n"
-    "- Troubleshooting: Start with the most common cause first, then alternatives\n"
-    "- Complex topics: Provide key information without unnecessary detail\n\n"
-    "STYLE:\n"
-    "- Talk like you're explaining to a colleague in person\n"
-    "- Be direct and practical - skip the fluff\n"
-    "- Use normal language, not robotic phrases\n"
-    "- If wiring is relevant, mention key connections only\n"
-    "- Focus on what they need to know, not everything possible\n\n"
-    "Query: {query_str}\n"
-    "Answer: "
-)
-query_engine.update_prompts({"response_synthesizer:text_qa_template": prompt_tmpl})
+query_engine = get_query_engine(index, generation) if index is not None else None
+
+def _preview(text, limit=400):
+    return text if len(text) <= limit else text[:limit] + "..."
+
+ANSWER_CACHE_SIZE = 128
+
+@st.cache_resource(show_spinner=False)
+def answer_cache():
+    """Answers shared by all sessions, keyed on (query, index generation);
+    the least recently used entry is dropped once the cache is full."""
+    return OrderedDict(), threading.Lock()
+
+def run_query(query, generation, on_text=None):
+    """Answer a query, keeping only what the page renders. Repeats of the
+    same question against the same index skip the embed + LLM round trip;
+    otherwise on_text gets the answer so far as each token arrives."""
+    cache, lock = answer_cache()
+    key = (query, generation)
+    with lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    response = query_engine.query(query)
+    text = ""
+    for token in response.response_gen:
+        text += token
+        if on_text:
+            on_text(text)
+    result = {
+        "response": text,
+        "sources": [{"score": node.score, "metadata": node.metadata, "preview": _preview(node.text)}
+                    for node in response.source_nodes or []],
+    }
+    with lock:
+        cache[key] = result
+        if len(cache) > ANSWER_CACHE_SIZE:
+            cache.popitem(last=False)
+    return result
 
 # ============================================================================
 # SEARCH UI
@@ -130,148 +219,130 @@ query_engine.update_prompts({"response_synthesizer:text_qa_template": prompt_tmp
 st.markdown("<h1 class='main-header'>📟 Engineer Advisor</h1>", unsafe_allow_html=True)
 st.markdown("<p class='sub-header'>Search manuals and quick guides</p>", unsafe_allow_html=True)
 
-query = st.text_input(
-    "🔍 Describe the fault or ask a question:",
-    placeholder="e.g., Zone 1 sensor not working",
-    help="Searches Quick Guides first (fast), then technical manuals (detailed)"
-)
-
-with st.expander("💡 Example Questions"):
-    st.markdown("""
-    - How do I troubleshoot door sensor connectivity issues?
-    - What are the wiring connections for panel zone 1?
-    - Explain the installation procedure for motion detectors
-    - What voltage should I expect at terminal X?
-    - How do I reset the main control panel?
-    """)
-
-if query:
-    try:
-        # Quick Fix match
-        quick_fix_match = find_quick_fix(query)
-        if quick_fix_match:
-            st.markdown("### ⚡ Quick Fix")
-            matched_kw = ', '.join(quick_fix_match['matched_keywords'][:5])
-            st.markdown(
-                f"""<div style='padding:1.5rem;border-radius:8px;background-color:#3d3d00;
-                border:2px solid #8d8d2d;margin:1rem 0;color:#ffffff;line-height:1.6;'>
-                <h4 style='color:#ffeb3b;margin-top:0;'>⚡ {quick_fix_match['fix']['title']}</h4>
-                <div style='margin:1rem 0;white-space:pre-wrap;font-family:system-ui;'>{quick_fix_match['fix']['answer']}</div>
-                <p style='margin-top:1rem;font-size:0.85em;color:#ffd54f;border-top:1px solid #8d8d2d;padding-top:0.5rem;'>
-                🎯 Matched: {matched_kw}</p></div>""",
-                unsafe_allow_html=True
-            )
-            st.markdown("---")
-
-        # Quick Guides keyword search
-        guides = load_quick_guides()
-        stop_words = {'how', 'to', 'the', 'a', 'an', 'on', 'in', 'at', 'for', 'with', 'is', 'do', 'i', 'my', 'can', 'you'}
-        query_words = [w.lower() for w in query.split() if len(w) > 2 and w.lower() not in stop_words]
-        matching_guides = []
-
-        if query_words:
-            for guide in guides:
-                guide_text = (guide['title'] + ' ' + guide['content']).lower()
-                matches = sum(1 for w in query_words if w in guide_text)
+# Fragment: submitting a query reruns only the search UI, not the app
+# shell, sidebar and index checks around it
+@st.fragment
+def render_search():
+    query = st.text_input(
+        "🔍 Describe the fault or ask a question:",
+        placeholder="e.g., Zone 1 sensor not working",
+        help="Searches Quick Guides first (fast), then technical manuals (detailed)"
+    )
+
+    with st.expander("💡 Example Questions"):
+        st.markdown("""
+        - How do I troubleshoot door sensor connectivity issues?
+        - What are the wiring connections for panel zone 1?
+        - Explain the installation procedure for motion detectors
+        - What voltage should I expect at terminal X?
+        - How do I reset the main control panel?
+        """)
+
+    if query:
+        try:
+            # Quick Fix match
+            quick_fix_match = find_quick_fix(query)
+            if quick_fix_match:
+                st.markdown("### ⚡ Quick Fix")
+                matched_kw = ', '.join(quick_fix_match['matched_keywords'][:5])
+                with st.container(border=True):
+                    st.markdown(f"#### ⚡ {quick_fix_match['fix']['title']}")
+                    st.text(quick_fix_match['fix']['answer'])
+                    st.caption(f"🎯 Matched: {matched_kw}")
+                st.markdown("---")
+
+            # Quick Guides keyword search
+            guides_version, guides = load_quick_guides_versioned()
+            query_tokens = tokenize(query)
+            query_words = {w for w in query_tokens if len(w) > 2 and w not in STOP_WORDS}
+            matching_guides = []
+
+            if query_words:
                 required = 1 if len(query_words) <= 2 else 2
-                if matches >= required:
-                    matching_guides.append({'guide': guide, 'match_count': matches,
-                                            'match_words': [w for w in query_words if w in guide_text]})
-            matching_guides.sort(key=lambda x: x['match_count'], reverse=True)
-
-        if matching_guides:
-            st.markdown("### 📝 Quick Reference Guides")
-            st.caption(f"Found {len(matching_guides)} guide(s) matching your keywords")
-            for match_info in matching_guides:
-                guide = match_info['guide']
-                matched_words = ', '.join(match_info['match_words'])
-                st.markdown(
-                    f"""<div style='padding:1.5rem;border-radius:8px;background-color:#1e3a5a;
-                    border:2px solid #2d5a8d;margin:1rem 0;color:#ffffff;line-height:1.6;'>
-                    <h4 style='color:#4da6ff;margin-top:0;'>📝 {guide['title']}</h4>
-                    <p style='margin:0.5rem 0;white-space:pre-wrap;'>{guide['content']}</p>
-                    <p style='margin-top:1rem;font-size:0.85em;color:#b3d9ff;'>
-                    Added by {guide['author']} • {guide['created']}<br>
-                    <span style='color:#80bfff;'>Matched: {matched_words}</span></p></div>""",
-                    unsafe_allow_html=True
-                )
-            st.markdown("---")
-
-        # AI manual search
-        with st.spinner("🔍 Searching technical manuals..."):
-            response = query_engine.query(query)
-
-        st.markdown("### 🛠 Technical Solution")
-        st.caption("From technical manuals and documentation")
-        st.markdown(f"<div class='success-box'>{response.response}</div>", unsafe_allow_html=True)
-
-        st.markdown("### 📚 Source References")
-        if hasattr(response, 'source_nodes') and response.source_nodes:
-            stop_words2 = {'how', 'to', 'the', 'a', 'an', 'on', 'in', 'at', 'for', 'with', 'is', 'do',
-                           'i', 'my', 'can', 'you', 'test', 'install', 'setup'}
-            query_keywords = [w.lower() for w in query.split() if len(w) > 3 and w.lower() not in stop_words2]
-
-            matching_title_sources, other_sources = [], []
-            for node in response.source_nodes:
-                if hasattr(node, 'score') and node.score < 0.5:
-                    continue
-                if node.metadata.get('source') == 'quick_guides':
-                    matching_title_sources.append(node)
+                postings = guide_postings(guides_version, guides)
+                hits = {}
+                for w in sorted(query_words):
+                    for i in postings.get(w, ()):
+                        hits.setdefault(i, []).append(w)
+                for i, words in sorted(hits.items()):
+                    if len(words) >= required:
+                        matching_guides.append({'guide': guides[i], 'match_count': len(words),
+                                                'match_words': words})
+                matching_guides.sort(key=lambda x: x['match_count'], reverse=True)
+
+            if matching_guides:
+                st.markdown("### 📝 Quick Reference Guides")
+                st.caption(f"Found {len(matching_guides)} guide(s) matching your keywords")
+                for match_info in matching_guides:
+                    guide = match_info['guide']
+                    with st.container(border=True):
+                        st.markdown(f"#### 📝 {guide['title']}")
+                        st.text(guide['content'])
+                        st.caption(f"Added by {guide['author']} • {guide['created']}  \n"
+                                   f"Matched: {', '.join(match_info['match_words'])}")
+                st.markdown("---")
+
+            # Skip the LLM round trip when a guide already covers every keyword
+            guides_only = (len(query_words) >= 2 and matching_guides
+                           and matching_guides[0]['match_count'] == len(query_words)
+                           and st.session_state.get('manuals_query') != query)
+            if query_engine is None:
+                st.info("📚 Manual search will be available once the index is built")
+            elif guides_only:
+                st.caption("⚡ A quick guide matched every keyword, so manuals were not searched.")
+                st.button("🔍 Also search manuals", on_click=st.session_state.update,
+                          kwargs={'manuals_query': query})
+            else:
+                # AI manual search, streamed into the answer box as it is generated
+                st.markdown("### 🛠 Technical Solution")
+                st.caption("From technical manuals and documentation")
+                answer_box = st.empty()
+
+                with ExitStack() as searching:
+                    searching.enter_context(st.spinner("🔍 Searching technical manuals..."))
+
+                    def show_answer(text):
+                        searching.close()  # the spinner ends at the first token
+                        answer_box.markdown(f"<div class='success-box'>{text}</div>", unsafe_allow_html=True)
+
+                    result = run_query(query, generation, on_text=show_answer)
+                show_answer(result['response'])
+
+                st.markdown("### 📚 Source References")
+                if result['sources']:
+                    # Sources arrive already ranked and trimmed by the reranker, and are exactly
+                    # the chunks the answer was built from; group by source, pages in the same pass
+                    grouped = {}
+                    for node in result['sources']:
+                        if node['metadata'].get('source') == 'quick_guides':
+                            key = '📝 Quick Reference Guides'
+                        else:
+                            key = node['metadata'].get('file_name', 'Unknown')
+                        group = grouped.setdefault(key, {'nodes': [], 'pages': set()})
+                        group['nodes'].append(node)
+                        page = node['metadata'].get('page_label', node['metadata'].get('page_number'))
+                        if page and str(page) not in ['N/A', 'None', '']:
+                            group['pages'].add(str(page))
+
+                    st.markdown("#### 🎯 Relevant Manuals")
+                    for file_name, group in grouped.items():
+                        if '📝' in file_name:
+                            st.info(file_name)
+                        else:
+                            nodes, pages = group['nodes'], group['pages']
+                            page_info = f" (Page{'s' if len(pages) > 1 else ''}: {', '.join(sorted(pages))})" if pages else ""
+                            with st.expander(f"📄 {file_name}{page_info}", expanded=True):
+                                for idx, node in enumerate(nodes, 1):
+                                    if node['score'] is not None:
+                                        st.caption(f"**Match {idx} - Relevance: {node['score']:.1%}**")
+                                    st.text(node['preview'])
+                                    if idx < len(nodes):
+                                        st.markdown("---")
                 else:
-                    file_name = node.metadata.get('file_name', '').lower()
-                    if any(kw in file_name for kw in query_keywords):
-                        matching_title_sources.append(node)
-                    else:
-                        other_sources.append(node)
-
-            def group_sources(sources):
-                grouped = {}
-                for node in sources:
-                    key = '📝 Quick Reference Guides' if node.metadata.get('source') == 'quick_guides' \
-                        else node.metadata.get('file_name', 'Unknown')
-                    grouped.setdefault(key, []).append(node)
-                return grouped
-
-            matching_grouped = group_sources(matching_title_sources)
-            other_grouped = group_sources(other_sources)
-
-            if matching_grouped:
-                st.markdown("#### 🎯 Relevant Manuals")
-                for file_name, nodes in matching_grouped.items():
-                    if '📝' in file_name:
-                        st.info(file_name)
-                    else:
-                        pages = set()
-                        for node in nodes:
-                            page = node.metadata.get('page_label', node.metadata.get('page_number'))
-                            if page and str(page) not in ['N/A', 'None', '']:
-                                pages.add(str(page))
-                        page_info = f" (Page{'s' if len(pages) > 1 else ''}: {', '.join(sorted(pages))})" if pages else ""
-                        with st.expander(f"📄 {file_name}{page_info}", expanded=True):
-                            for idx, node in enumerate(nodes, 1):
-                                if hasattr(node, 'score'):
-                                    st.caption(f"**Match {idx} - Relevance: {node.score:.1%}**")
-                                preview = node.text[:400] + "..." if len(node.text) > 400 else node.text
-                                st.text(preview)
-                                if idx < len(nodes):
-                                    st.markdown("---")
-
-            if other_grouped:
-                with st.expander(f"📋 Other References ({len(other_grouped)} manual(s))", expanded=False):
-                    for file_name, nodes in other_grouped.items():
-                        pages = set()
-                        for node in nodes:
-                            page = node.metadata.get('page_label', node.metadata.get('page_number'))
-                            if page and str(page) not in ['N/A', 'None', '']:
-                                pages.add(str(page))
-                        page_info = f" (Pages: {', '.join(sorted(pages))})" if pages else ""
-                        st.caption(f"📄 {file_name}{page_info}")
-
-            if not matching_grouped and not other_grouped:
-                st.info("No source references available")
-        else:
-            st.info("No source references available")
+                    st.info("No source references available")
 
-    except Exception as e:
-        st.error(f"❌ Query failed: {str(e)}")
-        st.info("💡 Try rephrasing or check system status")
+        except Exception as e:
+            st.error(f"❌ Query failed: {str(e)}")
+            st.info("💡 Try rephrasing or check system status")
+
+render_search()
@@ -1,6 +1,17 @@
 import streamlit as st
 import os
-import json
+import io
+import re
+import orjson
+import ahocorasick
+import asyncio
+import builtins
+import hashlib
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing, nullcontext
 from datetime import datetime
 from supabase import create_client, Client
 
@@ -51,15 +62,50 @@ def require_admin():
         st.stop()
 
 # ============================================================================
-# LOGO
+# STYLES & LOGO
 # ============================================================================
 
+# Whitespace is collapsed once at import so each rerun sends the minimal payload
+APP_CSS = re.sub(r"\s+", " ", """
+    <style>
+    .main-header { font-size: 2.5rem; font-weight: 700; color: #4da6ff; margin-bottom: 0.5rem; }
+    .sub-header { font-size: 1.2rem; color: #aaa; margin-bottom: 2rem; }
+    .stButton>button { width: 100%; border-radius: 5px; height: 3em; font-weight: 600; }
+    .success-box {
+        padding: 1.5rem; border-radius: 8px;
+        background-color: #1e3a1e; border: 2px solid #2d5a2d;
+        margin: 1rem 0; color: #ffffff; line-height: 1.6;
+    }
+    .admin-badge {
+        background-color: #ff6b6b; color: white;
+        padding: 0.2rem 0.5rem; border-radius: 3px;
+        font-size: 0.8rem; font-weight: bold;
+    }
+    .user-badge {
+        background-color: #4dabf7; color: white;
+        padding: 0.2rem 0.5rem; border-radius: 3px;
+        font-size: 0.8rem; font-weight: bold;
+    }
+    .logo-container {
+        text-align: center; padding: 1rem 0 2rem 0;
+        border-bottom: 2px solid #333; margin-bottom: 2rem;
+    }
+    .company-name { font-size: 2rem; font-weight: 700; color: #4da6ff; margin-top: 0.5rem; }
+    .guide-box {
+        background-color: #1e1e2e; border-left: 4px solid #4da6ff;
+        padding: 1rem; margin: 0.5rem 0; border-radius: 4px;
+    }
+    </style>
+""").strip()
+
+LOGO_PATH = "./assets/company_logo.png"
+HAS_LOGO = os.path.exists(LOGO_PATH)  # assets ship with the repo; checked once at import
+
 def display_logo():
-    logo_path = "./assets/company_logo.png"
-    if os.path.exists(logo_path):
+    if HAS_LOGO:
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
-            st.image(logo_path)
+            st.image(LOGO_PATH)
     else:
         st.markdown("""
             <div class="logo-container">
@@ -184,73 +230,178 @@ User code will be the master manager code (this has to be able to set the system
     }
 ]
 
-def find_quick_fix(query):
-    query_lower = query.lower()
-    stop_words = {'how', 'to', 'the', 'a', 'an', 'on', 'in', 'at', 'for', 'with', 'is', 'do', 'i', 'my', 'can', 'you', 'from'}
-    query_words = [word for word in query_lower.split() if len(word) > 2 and word not in stop_words]
+def _quick_fix_panels(quick_fix):
+    panels = quick_fix['panel'] if isinstance(quick_fix['panel'], list) else [quick_fix['panel']]
+    return [panel.lower() for panel in panels if panel]
+
+# Every distinct keyword gets one bit; a fix's keywords become an int mask
+_QF_KEYWORD_BITS = {}
+for _qf in QUICK_FIXES:
+    for _keyword in _qf['keywords']:
+        _QF_KEYWORD_BITS.setdefault(_keyword.lower(), 1 << len(_QF_KEYWORD_BITS))
+del _qf, _keyword
+
+# Frozen once at import: (max score, list position, fix, panels, keywords, keyword mask)
+# per fix, so the per-query loop does no isinstance() checks or dict lookups.
+# Ordered by best possible score so scoring can stop once nothing left can win
+_QF_RECORDS = tuple(sorted(
+    ((10 + mask.bit_count(), pos, qf, frozenset(_quick_fix_panels(qf)),
+      tuple(kw.lower() for kw in qf['keywords']), mask)
+     for pos, qf in enumerate(QUICK_FIXES)
+     for mask in [sum(_QF_KEYWORD_BITS[kw.lower()] for kw in set(qf['keywords']))]),
+    key=lambda record: (-record[0], record[1])))
+_QF_ALL_PANELS = frozenset().union(*(record[3] for record in _QF_RECORDS))
+
+# One Aho-Corasick automaton over every keyword and panel: a single pass over the
+# query finds all of them, overlapping matches included (same as `kw in query`)
+_QF_AUTOMATON = ahocorasick.Automaton()
+for _pattern in _QF_KEYWORD_BITS.keys() | _QF_ALL_PANELS:
+    _QF_AUTOMATON.add_word(_pattern, (_pattern, _QF_KEYWORD_BITS.get(_pattern, 0), _pattern in _QF_ALL_PANELS))
+_QF_AUTOMATON.make_automaton()
+del _pattern
 
-    best_match = None
+def find_quick_fix(query):
+    query_mask = 0
+    panels_in_query = set()
+    for _, (pattern, bit, is_panel) in _QF_AUTOMATON.iter(query.lower()):
+        query_mask |= bit
+        if is_panel:
+            panels_in_query.add(pattern)
+
+    best = None
     best_score = 0
+    best_pos = None
 
-    for quick_fix in QUICK_FIXES:
-        score = 0
-        matched_keywords = []
-
-        panels = quick_fix['panel'] if isinstance(quick_fix['panel'], list) else [quick_fix['panel']]
-        panel_match = any(panel and panel in query_lower for panel in panels)
-
-        if not any(panel in query_lower for qf in QUICK_FIXES
-                   for panel in (qf['panel'] if isinstance(qf['panel'], list) else [qf['panel']]) if panel):
-            panel_match = True
+    for max_score, pos, quick_fix, panels, keywords, mask in _QF_RECORDS:
+        # Ties go to the fix listed first, so only a strictly lower ceiling can stop the scan
+        if max_score < best_score:
+            break
 
-        if panel_match:
-            score += 10
+        # Keyword hits are a popcount; a fix needs at least 3
+        hit_count = (mask & query_mask).bit_count()
+        if hit_count < 3:
+            continue
 
-        for keyword in quick_fix['keywords']:
-            if keyword in query_lower:
-                matched_keywords.append(keyword)
-                score += 1
+        # With no panel named in the query, every fix's panel counts as matched
+        if panels_in_query and panels.isdisjoint(panels_in_query):
+            continue
 
-        if panel_match and len(matched_keywords) >= 3:
-            if score > best_score:
-                best_score = score
-                best_match = {
-                    'fix': quick_fix,
-                    'matched_keywords': matched_keywords,
-                    'panel_matched': panel_match
-                }
+        score = 10 + hit_count
+        if score > best_score or (score == best_score and pos < best_pos):
+            best_score, best_pos = score, pos
+            best = (quick_fix, keywords)
 
-    return best_match
+    if best is None:
+        return None
+    quick_fix, keywords = best
+    return {
+        'fix': quick_fix,
+        'matched_keywords': [kw for kw in keywords if _QF_KEYWORD_BITS[kw] & query_mask],
+        'panel_matched': True
+    }
 
 # ============================================================================
 # QUICK GUIDES
 # ============================================================================
 
 def load_quick_guides():
+    return load_quick_guides_versioned()[1]
+
+def load_quick_guides_versioned():
+    """(version, guides). The version changes only when the guides are re-read,
+    so anything derived from them can be cached on it without hashing the texts."""
     supabase = get_supabase()
-    if supabase is None:
-        return load_quick_guides_local()
+    if supabase is not None:
+        try:
+            fetched_at, data = _fetch_quick_guides(supabase)
+            if data:
+                return ('supabase', fetched_at), data
+        except Exception:
+            pass
+    return ('local',) + _guides_db_version(), load_quick_guides_local()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_quick_guides(_supabase):
+    """One table read shared by every page and rerun; save/delete clear it.
+    Returns (fetch time, rows); the time identifies this read."""
+    return time.time_ns(), _supabase.table('quick_guides').select('*').order('created', desc=True).execute().data
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Built once at import; page scripts re-execute on every rerun
+STOP_WORDS = frozenset({'how', 'to', 'the', 'a', 'an', 'on', 'in', 'at', 'for', 'with', 'is', 'do',
+                        'i', 'my', 'can', 'you'})
+
+def tokenize(text):
+    """Lowercased alphanumeric word set used for guide keyword matching."""
+    return set(_TOKEN_RE.findall(text.lower()))
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def guide_postings(version, _guides):
+    """Inverted index {word: [positions in guides]} over title + content.
+    Cached on the version from load_quick_guides_versioned(), so a query
+    never hashes or copies the guide texts; callers must not modify it."""
+    postings = {}
+    for i, guide in enumerate(_guides):
+        for token in tokenize(guide['title'] + ' ' + guide['content']):
+            postings.setdefault(token, []).append(i)
+    return postings
+
+GUIDES_DB = "./storage/guides.db"
+LEGACY_GUIDES_FILE = "./storage/quick_guides.json"
+
+def _guides_db():
+    """Open the local guides database, creating it on first use and
+    importing any guides from the old JSON file."""
     try:
-        response = supabase.table('quick_guides').select('*').order('created', desc=True).execute()
-        if response.data:
-            return response.data
-        return load_quick_guides_local()
-    except Exception as e:
-        return load_quick_guides_local()
+        # Fast path: the db exists, so WAL mode (persistent) and the table are already set up
+        conn = sqlite3.connect(f"file:{GUIDES_DB}?mode=rw", uri=True)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    except sqlite3.OperationalError:
+        pass
 
-def load_quick_guides_local():
     os.makedirs("./storage", exist_ok=True)
-    guides_file = "./storage/quick_guides.json"
-    if not os.path.exists(guides_file):
-        with open(guides_file, 'w') as f:
-            json.dump([], f)
-        return []
+    is_new = not os.path.exists(GUIDES_DB)
+    conn = sqlite3.connect(GUIDES_DB)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS guides("
+                 "id INTEGER PRIMARY KEY, title TEXT, content TEXT, author TEXT, created TEXT)")
+    if is_new and os.path.exists(LEGACY_GUIDES_FILE):
+        try:
+            with open(LEGACY_GUIDES_FILE, 'rb') as f:
+                legacy = orjson.loads(f.read())
+            with conn:
+                conn.executemany(
+                    "INSERT INTO guides(title, content, author, created) VALUES(?, ?, ?, ?)",
+                    [(g.get('title'), g.get('content'), g.get('author'), g.get('created')) for g in legacy])
+        except Exception:
+            pass
+    return conn
+
+def _guides_db_version():
+    """Modification times of the database and its WAL; changes on every write."""
+    version = []
+    for path in (GUIDES_DB, GUIDES_DB + "-wal"):
+        try:
+            version.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            version.append(0)
+    return tuple(version)
+
+@st.cache_data(show_spinner=False)
+def _read_guides_db(version):
+    """Read all local guides; keyed on the db version so writes invalidate it."""
+    with closing(_guides_db()) as conn:
+        return [dict(row) for row in conn.execute("SELECT * FROM guides ORDER BY id")]
+
+def load_quick_guides_local():
     try:
-        with open(guides_file, 'r') as f:
-            return json.load(f)
+        return _read_guides_db(_guides_db_version())
     except Exception:
-        with open(guides_file, 'w') as f:
-            json.dump([], f)
         return []
 
 def save_quick_guide(title, content, author):
@@ -261,26 +412,21 @@ def save_quick_guide(title, content, author):
         response = supabase.table('quick_guides').insert({
             "title": title, "content": content, "author": author
         }).execute()
+        _fetch_quick_guides.clear()
         return response.data[0] if response.data else None
     except Exception as e:
         st.error(f"Error saving guide: {e}")
         return save_quick_guide_local(title, content, author)
 
 def save_quick_guide_local(title, content, author):
-    os.makedirs("./storage", exist_ok=True)
-    guides_file = "./storage/quick_guides.json"
-    guides = load_quick_guides_local()
-    new_guide = {
-        "id": len(guides) + 1,
-        "title": title,
-        "content": content,
-        "author": author,
-        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-    guides.append(new_guide)
-    with open(guides_file, 'w') as f:
-        json.dump(guides, f, indent=2)
-    return new_guide
+    created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with closing(_guides_db()) as conn, conn:
+        cursor = conn.execute(
+            "INSERT INTO guides(title, content, author, created) VALUES(?, ?, ?, ?)",
+            (title, content, author, created))
+    _read_guides_db.clear()
+    return {"id": cursor.lastrowid, "title": title, "content": content,
+            "author": author, "created": created}
 
 def delete_quick_guide(guide_id):
     supabase = get_supabase()
@@ -288,16 +434,15 @@ def delete_quick_guide(guide_id):
         return delete_quick_guide_local(guide_id)
     try:
         supabase.table('quick_guides').delete().eq('id', guide_id).execute()
+        _fetch_quick_guides.clear()
     except Exception as e:
         st.error(f"Error deleting guide: {e}")
         delete_quick_guide_local(guide_id)
 
 def delete_quick_guide_local(guide_id):
-    guides_file = "./storage/quick_guides.json"
-    guides = load_quick_guides_local()
-    guides = [g for g in guides if g.get('id') != guide_id]
-    with open(guides_file, 'w') as f:
-        json.dump(guides, f, indent=2)
+    with closing(_guides_db()) as conn, conn:
+        conn.execute("DELETE FROM guides WHERE id = ?", (guide_id,))
+    _read_guides_db.clear()
 
 # ============================================================================
 # SUPABASE STORAGE — MANUALS
@@ -305,8 +450,10 @@ def delete_quick_guide_local(guide_id):
 
 MANUALS_BUCKET = "manuals"
 
+@st.cache_data(ttl=30, show_spinner=False)
 def list_manuals():
-    """List PDF files in Supabase Storage."""
+    """List PDF files in Supabase Storage. Cached briefly so reruns don't
+    hit the storage API; upload/delete invalidate it."""
     supabase = get_supabase()
     if supabase is None:
         return _list_manuals_local()
@@ -321,21 +468,90 @@ def _list_manuals_local():
         return [f for f in os.listdir("./manuals") if f.endswith('.pdf')]
     return []
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def _list_diagrams(dir_mtime):
+    diagrams = {}
+    for f in sorted(entry.name for entry in os.scandir("./diagrams") if entry.is_file()):
+        if f.lower().endswith(('.png', '.jpg', '.jpeg')):
+            title = f.replace('-', ' ').replace('_', ' ').rsplit('.', 1)[0].title()
+            diagrams.setdefault(title, f)
+    return diagrams
+
+def list_diagrams():
+    """Map display title -> image file in ./diagrams (diagrams ship with the repo).
+    Keyed on the folder's mtime, so adding or removing a file rescans it."""
+    try:
+        return _list_diagrams(os.stat("./diagrams").st_mtime_ns)
+    except FileNotFoundError:
+        return {}
+
 def upload_manual(filename, data):
-    """Upload a PDF to Supabase Storage, overwriting if it exists."""
+    """Upload a PDF to Supabase Storage, overwriting if it exists.
+    data is the file's bytes or a local path (streamed from disk)."""
     supabase = get_supabase()
     if supabase is None:
         return False, "Supabase not connected"
     try:
-        supabase.storage.from_(MANUALS_BUCKET).upload(
-            path=filename,
-            file=data,
-            file_options={"content-type": "application/pdf", "upsert": "true"}
-        )
+        # storage3 opens a path itself and never closes it, so pass an open handle
+        with nullcontext(data) if isinstance(data, bytes) else open(data, 'rb') as f:
+            supabase.storage.from_(MANUALS_BUCKET).upload(
+                path=filename,
+                file=f,
+                file_options={"content-type": "application/pdf", "upsert": "true"}
+            )
+        list_manuals.clear()
+        get_manual_bytes.clear()
         return True, None
     except Exception as e:
         return False, str(e)
 
+def _file_version(path):
+    """(mtime_ns, size) of a local file; changes whenever the file is replaced."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _file_bytes(path, version):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def file_bytes(path):
+    """Contents of a local file, read once and cached until it changes."""
+    return _file_bytes(path, _file_version(path))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _image_preview(path, version, width):
+    from PIL import Image
+
+    with Image.open(path) as im:
+        if max(im.size) <= width:
+            return file_bytes(path)
+        im.thumbnail((width, width))
+        if im.mode in ('RGBA', 'LA', 'P'):
+            im = im.convert('RGBA')
+            background = Image.new('RGB', im.size, 'white')
+            background.paste(im, mask=im.getchannel('A'))
+            im = background
+        buf = io.BytesIO()
+        im.convert('RGB').save(buf, 'JPEG', quality=85)
+        return buf.getvalue()
+
+def image_preview(path, width=1024):
+    """Downscaled JPEG of a local image for on-page display, cached until
+    the file changes. Downloads should still serve the original."""
+    return _image_preview(path, _file_version(path), width)
+
+def save_manual_local(filename, fileobj):
+    """Stream an uploaded PDF to ./manuals/ in 1 MiB chunks so indexing can
+    use it without re-downloading from Supabase. Writes to a .part file so an
+    existing copy survives a failed upload; os.replace it into place after."""
+    os.makedirs("./manuals", exist_ok=True)
+    local_path = f"./manuals/{filename}.part"
+    fileobj.seek(0)
+    with open(local_path, 'wb') as f:
+        shutil.copyfileobj(fileobj, f, length=1 << 20)
+    return local_path
+
 def download_manual(filename):
     """Download a PDF from Supabase Storage. Returns bytes or None."""
     supabase = get_supabase()
@@ -346,6 +562,12 @@ def download_manual(filename):
     except Exception:
         return None
 
+@st.cache_data(ttl=300, max_entries=4, show_spinner=False)
+def get_manual_bytes(filename):
+    """download_manual() cached briefly so reruns don't re-download the
+    selected PDF."""
+    return download_manual(filename)
+
 def delete_manual(filename):
     """Delete a PDF from Supabase Storage."""
     supabase = get_supabase()
@@ -353,13 +575,16 @@ def delete_manual(filename):
         return False
     try:
         supabase.storage.from_(MANUALS_BUCKET).remove([filename])
+        list_manuals.clear()
+        get_manual_bytes.clear()
         return True
     except Exception:
         return False
 
 def sync_manuals_to_local():
     """Download all PDFs from Supabase Storage to ./manuals/ for indexing.
-    Skips files already present locally."""
+    Skips files already present locally. Returns only the manuals that are
+    actually on disk, so a failed download is left out rather than indexed."""
     os.makedirs("./manuals", exist_ok=True)
     files = list_manuals()
     for filename in files:
@@ -369,7 +594,7 @@ def sync_manuals_to_local():
             if data:
                 with open(local_path, 'wb') as f:
                     f.write(data)
-    return files
+    return [f for f in files if os.path.exists(f"./manuals/{f}")]
 
 
 # ============================================================================
@@ -384,10 +609,13 @@ INDEX_FILES = [
     'default__vector_store.json',
     'graph_store.json',
     'image__vector_store.json',
+    'fingerprint.json',
 ]
 
+@st.cache_resource(show_spinner=False)
 def _supabase_direct():
-    """Create a Supabase client directly from secrets (safe inside cached functions)."""
+    """Shared Supabase client built from secrets once per process (no user
+    session, so safe inside cached functions and background threads)."""
     try:
         return create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"])
     except Exception:
@@ -445,27 +673,290 @@ def upload_index_to_supabase():
         return False
 
 
+# ============================================================================
+# LLM CLIENTS
+# ============================================================================
+
+@st.cache_resource(show_spinner=False)
+def get_llm_and_embed():
+    """Build the OpenAI LLM and embedding clients once per process so their
+    pooled HTTP connections are reused across reruns and queries."""
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    from llama_index.llms.openai import OpenAI
+
+    os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
+    os.environ["LLAMA_CLOUD_API_KEY"] = st.secrets["LLAMA_CLOUD_API_KEY"]
+    return (OpenAI(model="gpt-4o-mini", temperature=0.1),
+            OpenAIEmbedding(model="text-embedding-3-small"))
+
+RETRIEVE_TOP_K = 32  # coarse candidates per retriever (FAISS, BM25) and after fusion
+RERANK_TOP_N = 3     # chunks actually sent to the LLM
+
+QA_PROMPT = (
+    "Context information is below.\n"
+    "---------------------\n"
+    "{context_str}\n"
+    "---------------------\n"
+    "You are a senior field engineer helping a colleague. Answer naturally and conversationally.\n\n"
+    "ADAPT YOUR RESPONSE:\n"
+    "- Simple questions (what/where/when): Answer directly in 1-2 sentences\n"
+    "- How-to questions: Give clear, practical steps (3-5 steps)\n"
+    "- Troubleshooting: Start with the most common cause first, then alternatives\n"
+    "- Complex topics: Provide key information without unnecessary detail\n\n"
+    "STYLE:\n"
+    "- Talk like you're explaining to a colleague in person\n"
+    "- Be direct and practical - skip the fluff\n"
+    "- Use normal language, not robotic phrases\n"
+    "- If wiring is relevant, mention key connections only\n"
+    "- Focus on what they need to know, not everything possible\n\n"
+    "Query: {query_str}\n"
+    "Answer: "
+)
+
+@st.cache_resource(show_spinner=False)
+def get_reranker():
+    """Local cross-encoder that reorders the FAISS candidates so only the
+    best few chunks reach the LLM prompt."""
+    from llama_index.core.postprocessor import SentenceTransformerRerank
+    return SentenceTransformerRerank(model="BAAI/bge-reranker-base", top_n=RERANK_TOP_N)
+
+# A plain module global rather than st.cache_resource, so clearing Streamlit's
+# caches never orphans a running loop thread
+_EVENT_LOOP = None
+_EVENT_LOOP_LOCK = threading.Lock()
+
+def _event_loop():
+    """One long-lived asyncio loop on a daemon thread, shared by all sessions."""
+    global _EVENT_LOOP
+    with _EVENT_LOOP_LOCK:
+        if _EVENT_LOOP is None:
+            _EVENT_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_EVENT_LOOP.run_forever, daemon=True, name="async-loop").start()
+    return _EVENT_LOOP
+
+def run_async(coro):
+    """Run a coroutine on the shared loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+def build_query_engine(index, streaming=False):
+    """Query engine with the shared retrieve/rerank settings and QA prompt.
+    Candidates come from FAISS and BM25 fused by reciprocal rank, so exact
+    terms (part numbers, panel models) are found even when embeddings miss them.
+    With streaming, query() returns as soon as retrieval is done and the
+    answer is read token by token from response.response_gen."""
+    from llama_index.core import PromptTemplate
+    from llama_index.core.query_engine import RetrieverQueryEngine
+    from llama_index.core.retrievers import QueryFusionRetriever
+    from llama_index.retrievers.bm25 import BM25Retriever
+
+    retriever = QueryFusionRetriever(
+        [index.as_retriever(similarity_top_k=RETRIEVE_TOP_K),
+         BM25Retriever.from_defaults(docstore=index.docstore, similarity_top_k=RETRIEVE_TOP_K)],
+        mode="reciprocal_rerank", num_queries=1, similarity_top_k=RETRIEVE_TOP_K, use_async=False)
+    query_engine = RetrieverQueryEngine.from_args(retriever, node_postprocessors=[get_reranker()],
+                                                  streaming=streaming)
+    query_engine.update_prompts({"response_synthesizer:text_qa_template": PromptTemplate(QA_PROMPT)})
+    return query_engine
+
+async def batched_query(query_engine, queries):
+    """Run several queries concurrently against one engine, in input order."""
+    return await asyncio.gather(*(query_engine.aquery(q) for q in queries))
+
+# ============================================================================
+# PDF PARSING
+# ============================================================================
+
+def parse_manuals(paths):
+    """Parse PDFs with LlamaParse, one file per worker thread.
+    Parsing is network-bound on LlamaCloud, so threads overlap the waits."""
+    from concurrent.futures import ThreadPoolExecutor
+    from llama_index.core import SimpleDirectoryReader
+    from llama_parse import LlamaParse
+
+    if not paths:
+        return []
+    parser = LlamaParse(result_type="markdown", invalidate_cache=False, do_not_cache=False)
+
+    def _parse(path):
+        return SimpleDirectoryReader(input_files=[path], file_extractor={".pdf": parser}).load_data()
+
+    with ThreadPoolExecutor(max_workers=min(16, len(paths))) as pool:
+        return [doc for docs in pool.map(_parse, paths) for doc in docs]
+
+
+# ============================================================================
+# VECTOR STORE
+# ============================================================================
+
+EMBED_DIM = 1536  # text-embedding-3-small
+HNSW_MIN_VECTORS = 50_000  # below this, exact brute force beats HNSW on latency and recall
+# Components of unit-length 1536-d embeddings sit around ±0.03 and rarely pass ±0.15;
+# ±0.3 fits them all while still spreading them over the 256 int8 codes
+SQ_RANGE = 0.3
+
+def new_storage_context(num_vectors):
+    """Storage context backed by a FAISS inner-product index.
+    OpenAI embeddings are unit length, so inner product == cosine.
+    Stored vectors are int8 scalar-quantized (4x less memory than float32)
+    over a fixed ±SQ_RANGE per dimension, so manuals inserted later share
+    the build's codes; small corpora get an exact flat scan, large ones HNSW."""
+    import faiss
+    import numpy as np
+    from llama_index.core import StorageContext
+    from llama_index.vector_stores.faiss import FaissVectorStore
+
+    if num_vectors < HNSW_MIN_VECTORS:
+        faiss_index = faiss.IndexScalarQuantizer(
+            EMBED_DIM, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        faiss_index = faiss.IndexHNSWSQ(
+            EMBED_DIM, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        faiss_index.hnsw.efConstruction = 128
+    # A fixed range rather than the first build's min/max, so later inserts
+    # aren't clipped to whatever that corpus happened to span
+    faiss_index.train(np.array([[-SQ_RANGE] * EMBED_DIM, [SQ_RANGE] * EMBED_DIM], dtype=np.float32))
+    vector_store = FaissVectorStore(faiss_index=faiss_index)
+    return StorageContext.from_defaults(vector_store=vector_store)
+
+EMBED_CACHE_DIR = "./embed_cache"  # outside ./storage so it survives Rebuild
+
+def _embed_texts(texts):
+    """Embed texts, reusing vectors cached on disk by content hash so
+    re-indexing only pays for chunks that actually changed."""
+    import numpy as np
+    from llama_index.core import Settings
+
+    cache_dir = f"{EMBED_CACHE_DIR}/{Settings.embed_model.model_name}"
+    paths = []
+    for text in texts:
+        h = hashlib.sha256(text.encode()).hexdigest()
+        paths.append(f"{cache_dir}/{h[:2]}/{h}.npy")
+
+    embeddings = [None] * len(texts)
+    if os.path.isdir(cache_dir):
+        missing = []
+        for i, path in enumerate(paths):
+            try:
+                embeddings[i] = np.load(path).tolist()
+            except (OSError, ValueError):
+                missing.append(i)
+    else:
+        # Cold cache (first bulk ingest): every lookup would miss, so skip them
+        missing = list(range(len(texts)))
+
+    if missing:
+        fresh = Settings.embed_model.get_text_embedding_batch([texts[i] for i in missing])
+        # Write the cache in one pass after the API work, never interleaved with it
+        for i, embedding in zip(missing, fresh):
+            embeddings[i] = embedding
+        for d in {os.path.dirname(paths[i]) for i in missing}:
+            os.makedirs(d, exist_ok=True)
+        for i in missing:
+            np.save(paths[i], np.asarray(embeddings[i], dtype=np.float32))
+    return embeddings
+
+def embed_documents(documents):
+    """Chunk documents into nodes carrying their embeddings."""
+    from llama_index.core import Settings
+    from llama_index.core.schema import MetadataMode
+
+    nodes = Settings.node_parser.get_nodes_from_documents(documents)
+    embeddings = _embed_texts([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    return nodes
+
+def build_index(documents):
+    """Chunk and embed documents, then build a new index sized to the chunk count."""
+    from llama_index.core import VectorStoreIndex
+
+    nodes = embed_documents(documents)
+    if not nodes:
+        raise ValueError("No text could be extracted from the manuals, so there is nothing to index")
+    return VectorStoreIndex(nodes, storage_context=new_storage_context(len(nodes)))
+
+def load_index(storage_path="./storage"):
+    """Load a persisted FAISS-backed index from storage_path."""
+    from llama_index.core import StorageContext, load_index_from_storage
+    from llama_index.vector_stores.faiss import FaissVectorStore
+
+    vector_store = FaissVectorStore.from_persist_dir(storage_path)
+    sc = StorageContext.from_defaults(vector_store=vector_store, persist_dir=storage_path)
+    return load_index_from_storage(sc)
+
+def clear_local_index(storage_path="./storage"):
+    """Remove the local index without blocking: rename the folder (instant)
+    and delete it on a daemon thread, along with any earlier leftovers."""
+    if os.path.exists(storage_path):
+        os.rename(storage_path, f"{storage_path}.trash.{time.time_ns()}")
+    parent, name = os.path.split(storage_path)
+    trash = [os.path.join(parent, d) for d in os.listdir(parent or ".") if d.startswith(f"{name}.trash.")]
+    for path in trash:
+        threading.Thread(target=shutil.rmtree, args=(path,), kwargs={"ignore_errors": True},
+                         daemon=True).start()
+
+# The Search page keys its cached index on this, so admin changes drop only the
+# index, not the LLM clients and reranker held in st.cache_resource
+_INDEX_GENERATION = 0
+
+def index_generation():
+    return _INDEX_GENERATION
+
+def invalidate_index_cache():
+    """Make every session reload the index on its next run."""
+    global _INDEX_GENERATION
+    _INDEX_GENERATION += 1
+
+
+# ============================================================================
+# INDEX FINGERPRINT
+# ============================================================================
+
+FINGERPRINT_FILE = "./storage/fingerprint.json"
+
+def manual_fingerprints(filenames):
+    """Content hash of each local manual, keyed by filename."""
+    fingerprints = {}
+    for filename in filenames:
+        with open(f"./manuals/{filename}", 'rb') as f:
+            fingerprints[filename] = hashlib.file_digest(f, 'sha256').hexdigest()
+    return fingerprints
+
+def load_index_fingerprints():
+    """Fingerprints of the manuals already in the persisted index."""
+    try:
+        with open(FINGERPRINT_FILE, 'rb') as f:
+            return orjson.loads(f.read())
+    except Exception:
+        return {}
+
+def save_index_fingerprints(fingerprints):
+    with open(FINGERPRINT_FILE, 'wb') as f:
+        f.write(orjson.dumps(fingerprints, option=orjson.OPT_INDENT_2))
+
+
 # ============================================================================
 # INCREMENTAL INDEXING
 # ============================================================================
 
+# Background index jobs (the Search page's full build and the admin insert) are
+# kept on the builtins module so they outlive page reruns. Page scripts
+# re-execute on every rerun, so the lock guarding their check-then-set lives here.
+INDEX_JOB_LOCK = threading.Lock()
+
+def index_job_running():
+    """True while a background index build or insert has not finished."""
+    jobs = (getattr(builtins, '_build_job', None), getattr(builtins, '_index_job', None))
+    return any(job is not None and not job['done'] for job in jobs)
+
 def insert_manuals_into_index(filenames):
     """Insert one or more PDFs into the existing index without full rebuild.
     Returns (success: bool, error: str or None)."""
     import os
-    from llama_index.core import (
-        StorageContext, load_index_from_storage,
-        VectorStoreIndex, SimpleDirectoryReader, Settings
-    )
-    from llama_index.embeddings.openai import OpenAIEmbedding
-    from llama_index.llms.openai import OpenAI
-    from llama_parse import LlamaParse
+    from llama_index.core import Settings
 
     try:
-        os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
-        os.environ["LLAMA_CLOUD_API_KEY"] = st.secrets["LLAMA_CLOUD_API_KEY"]
-        Settings.llm = OpenAI(model="gpt-4o-mini", temperature=0.1)
-        Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
+        Settings.llm, Settings.embed_model = get_llm_and_embed()
     except Exception as e:
         return False, f"API config error: {e}"
 
@@ -492,31 +983,38 @@ def insert_manuals_into_index(filenames):
                 return False, f"Could not download {filename} from Supabase: {e}"
 
     try:
-        # Load existing index or create empty one
         required = ['docstore.json', 'index_store.json']
         has_index = all(os.path.exists(f"{storage_path}/{f}") for f in required)
 
-        if has_index:
-            sc = StorageContext.from_defaults(persist_dir=storage_path)
-            index = load_index_from_storage(sc)
-        else:
-            index = VectorStoreIndex([])
+        # Skip files whose content is already indexed (e.g. re-uploads)
+        fingerprints = manual_fingerprints(filenames)
+        indexed = load_index_fingerprints() if has_index else {}
+        filenames = [f for f in filenames if indexed.get(f) != fingerprints[f]]
+        if not filenames:
+            return True, None
+        # Vectors can't be removed from the index, so appending a changed manual
+        # would leave its old chunks searchable next to the new ones
+        changed = [f for f in filenames if f in indexed]
+        if changed:
+            return False, (f"{', '.join(changed)} changed since it was indexed; "
+                           f"use Rebuild Index in the System tab to replace the old content")
 
         # Parse only the new PDFs
-        parser = LlamaParse(result_type="markdown", invalidate_cache=False, do_not_cache=False)
-        local_paths = [f"./manuals/{f}" for f in filenames]
-        documents = SimpleDirectoryReader(
-            input_files=local_paths,
-            file_extractor={".pdf": parser}
-        ).load_data()
+        documents = parse_manuals([f"./manuals/{f}" for f in filenames])
+        if not documents:
+            return False, f"No text could be extracted from {', '.join(filenames)}"
 
-        # Insert new documents into existing index
-        for doc in documents:
-            index.insert(doc)
+        # Insert new documents into existing index, or build one if none exists
+        if has_index:
+            index = load_index(storage_path)
+            index.insert_nodes(embed_documents(documents))
+        else:
+            index = build_index(documents)
 
         # Persist updated index locally then push to Supabase
         os.makedirs(storage_path, exist_ok=True)
         index.storage_context.persist(persist_dir=storage_path)
+        save_index_fingerprints({**indexed, **fingerprints})
         upload_index_to_supabase()
 
         return True, None
@@ -529,13 +1027,15 @@ def get_quick_guides_as_text():
     guides = load_quick_guides()
     if not guides:
         return ""
-    text = "\n\n=== QUICK REFERENCE GUIDES ===\n\n"
+    parts = ["\n\n=== QUICK REFERENCE GUIDES ===\n\n"]
     for guide in guides:
         created_str = guide.get('created', '')
         display_date = created_str if isinstance(created_str, str) else (
             created_str.strftime("%Y-%m-%d %H:%M:%S") if created_str else "")
-        text += f"\n--- {guide['title']} ---\n"
-        text += f"Author: {guide['author']} | Created: {display_date}\n"
-        text += f"{guide['content']}\n"
-        text += "-" * 50 + "\n"
-    return text
+        parts.append(
+            f"\n--- {guide['title']} ---\n"
+            f"Author: {guide['author']} | Created: {display_date}\n"
+            f"{guide['content']}\n"
+            f"{'-' * 50}\n"
+        )
+    return "".join(parts)